@@ -32,4 +32,7 @@ function(add_libtbx_refresh_command refresh_script)
   set_target_properties (${PROJECT_NAME}_refresh PROPERTIES FOLDER refresh)
   add_dependencies(${PROJECT_NAME} ${PROJECT_NAME}_refresh)
   add_dependencies(refresh_meta ${PROJECT_NAME}_refresh)
+  # Record the script so that watch_libtbx.py knows it can be rerun
+  get_filename_component(refresh_script_path ${refresh_script} ABSOLUTE)
+  set_property(GLOBAL APPEND PROPERTY TBX_REFRESH_SCRIPTS ${refresh_script_path})
 endfunction()
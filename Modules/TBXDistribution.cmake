@@ -47,17 +47,24 @@ function(find_libtbx_module name)
   message(WARNING "find_libtbx_module currently does nothing")
 endfunction()
 
-# Handle env generation - accumulate global lists of modules and paths
-define_property(GLOBAL PROPERTY TBX_MODULES
-    BRIEF_DOCS "List of all TBX modules configured"
-    FULL_DOCS "List of all TBX modules configured")
-define_property(GLOBAL PROPERTY TBX_MODULES_PATHS
-    BRIEF_DOCS "List of all TBX modules paths configured"
-    FULL_DOCS "List of all TBX modules paths configured")
+# Handle env generation - accumulate global lists of modules and paths.
+# In script mode (used by regenerate_dispatchers.cmake) only the dispatcher
+# functions are wanted, so skip anything that can't be run there.
+if (NOT CMAKE_SCRIPT_MODE_FILE)
+  define_property(GLOBAL PROPERTY TBX_MODULES
+      BRIEF_DOCS "List of all TBX modules configured"
+      FULL_DOCS "List of all TBX modules configured")
+  define_property(GLOBAL PROPERTY TBX_MODULES_PATHS
+      BRIEF_DOCS "List of all TBX modules paths configured"
+      FULL_DOCS "List of all TBX modules paths configured")
+endif()
 # set_property(GLOBAL PROPERTY TBX_MODULES "")
 # set_property(GLOBAL PROPERTY TBX_MODULES "")
 
 get_filename_component(LIBTBX_ENV_PY ${CMAKE_CURRENT_LIST_DIR}/../write_libtbx_env.py ABSOLUTE)
+# Used by the dispatchers when LIBTBX_DISPATCHER_PROFILE is set
+get_filename_component(LIBTBX_DISPATCHER_PROFILE_PY ${CMAKE_CURRENT_LIST_DIR}/../dispatcher_profile.py ABSOLUTE)
+get_filename_component(LIBTBX_WATCH_PY ${CMAKE_CURRENT_LIST_DIR}/../watch_libtbx.py ABSOLUTE)
 
 function(write_libtbx_env)
   # Set up a target to write the environment
@@ -71,6 +78,25 @@ function(write_libtbx_env)
     COMMAND "${Python_EXECUTABLE}" ${LIBTBX_ENV_PY} "${tbx_modules}" "${tbx_modules_paths}"
   )
 
+  # Write the settings that watch_libtbx.py needs to redo configure steps
+  get_property(tbx_refresh_scripts GLOBAL PROPERTY TBX_REFRESH_SCRIPTS)
+  set(refresh_json "")
+  foreach(refresh_script ${tbx_refresh_scripts})
+    if (refresh_json)
+      string(APPEND refresh_json ",")
+    endif()
+    string(APPEND refresh_json "\n    \"${refresh_script}\"")
+  endforeach()
+  file(WRITE ${CMAKE_BINARY_DIR}/libtbx_watch.json
+"{
+  \"source_dir\": \"${CMAKE_SOURCE_DIR}\",
+  \"python\": \"${Python_EXECUTABLE}\",
+  \"cmake\": \"${CMAKE_COMMAND}\",
+  \"refresh_scripts\": [${refresh_json}
+  ]
+}
+")
+
   # add_custom_command(
   #   COMMAND Python::Python ${LIBTBX_ENV_PY} 
   #     WORKING_DIRECTORY ${CMAKE_BINARY_DIR}
@@ -125,7 +151,7 @@ endfunction()
 function(_read_libtbx_config file entry)
   # Read and parse
   file(READ ${file} libtbx_config_contents)
-  sbeParseJson(config libtbx_config)
+  sbeParseJson(config libtbx_config_contents)
   # Loop over entries to build the list
   foreach(var ${config.${entry}})
     # message("${var} = ${${var}}")
@@ -179,11 +205,13 @@ endfunction()
 # it out to <destination>. Useful extra variables for template file:
 #   DISPATCHER_TARGET   The target script for the dispatcher to run
 #   PYTHON_EXECUTABLE   The full path to the python interpreter
+#   LIBTBX_DISPATCHER_PROFILE_PY
+#                       The script used to profile dispatcher startup
 function(_write_dispatcher destination DISPATCHER_TARGET)
   # Template depends on the type of file...
-  if (target MATCHES "\\.py$")
+  if (DISPATCHER_TARGET MATCHES "\\.py$")
     set(dispatcher_template "${__TBXDistribution_list_dir}/../dispatcher.py.template")
-  elseif(target MATCHES "\\.sh$")
+  elseif(DISPATCHER_TARGET MATCHES "\\.sh$")
     set(dispatcher_template "${__TBXDistribution_list_dir}/../dispatcher.sh.template")
   else()
     message(WARNING "Unknown dispatcher type for target ${DISPATCHER_TARGET}; ignoring")
@@ -197,15 +225,15 @@ function(_write_dispatcher destination DISPATCHER_TARGET)
 endfunction()
 
 # ::
-#   _generate_libtbx_dispatchers(<name> <path>)
+#   _find_libtbx_dispatcher_targets(<path> <locations> <targets>)
 #
-# Read a libtbx module path and generate dispatchers by reading the
-# command_line folder and any additional folders listed in the
-# libtbx_config file's "extra_command_line_locations" entry.
+# Read a libtbx module path and find every script that should have a
+# dispatcher, by reading the command_line folder and any additional folders
+# listed in the libtbx_config file's "extra_command_line_locations" entry.
 #
-# <name> is used to create the default dispatcher name - <name>.<target>
-#
-function(_generate_libtbx_dispatchers name path)
+# The searched folders are put in <locations>, and the scripts found (both
+# relative to <path>) are put in <targets>.
+function(_find_libtbx_dispatcher_targets path locations targets)
   # Read the libtbx_config to see if there are any extra locations to search
   set(dispatcher_locations command_line)
   if (EXISTS ${path}/libtbx_config)
@@ -214,9 +242,10 @@ function(_generate_libtbx_dispatchers name path)
   endif()
 
   # Find potential targets in each of these locations
+  set(dispatcher_targets "")
   foreach(dir ${dispatcher_locations})
     # Find targets in this folder, relative to the module root
-    file(GLOB matches LIST_DIRECTORIES false RELATIVE ${path} ${dir}/*.py ${dir}/*.sh)
+    file(GLOB matches LIST_DIRECTORIES false RELATIVE ${path} ${path}/${dir}/*.py ${path}/${dir}/*.sh)
     # Exclude items from this list that don't match the criteria; A
     # script is a potential dispatcher IF:
     #   - Filename ends with .py or .sh
@@ -231,6 +260,38 @@ function(_generate_libtbx_dispatchers name path)
       endif()
     endforeach()
   endforeach()
+  set(${locations} "${dispatcher_locations}" PARENT_SCOPE)
+  set(${targets} "${dispatcher_targets}" PARENT_SCOPE)
+endfunction()
+
+# ::
+#   _write_libtbx_script_dispatchers(<name> <path> <target> <output>)
+#
+# Write the dispatchers for a single script <target>, relative to the
+# module <path>. The names of the dispatchers written are put in <output>.
+function(_write_libtbx_script_dispatchers name path target output)
+  get_filename_component(target_stripped_name "${target}" NAME)
+  # Get the filename without final extension
+  string(REGEX REPLACE "\\.[^.]*$" "" target_stripped_name "${target_stripped_name}")
+  # Work out if we had any "rename" directives inside the file
+  _get_libtbx_dispatcher_rename(${path}/${target} "${name}.${target_stripped_name}" dispatcher_names)
+  foreach(dispatcher_name ${dispatcher_names})
+    # Write this dispatcher
+    _write_dispatcher(${CMAKE_BINARY_DIR}/bin/${dispatcher_name} ${path}/${target})
+  endforeach()
+  set(${output} "${dispatcher_names}" PARENT_SCOPE)
+endfunction()
+
+# ::
+#   _generate_libtbx_dispatchers(<name> <path>)
+#
+# Generate dispatchers for every script found in a libtbx module path by
+# _find_libtbx_dispatcher_targets.
+#
+# <name> is used to create the default dispatcher name - <name>.<target>
+#
+function(_generate_libtbx_dispatchers name path)
+  _find_libtbx_dispatcher_targets(${path} dispatcher_locations dispatcher_targets)
   list(LENGTH dispatcher_targets dispatcher_count)
   # Pass this count up to the parent function
   set(${name}_DISPATCHER_COUNT ${dispatcher_count} PARENT_SCOPE)
@@ -242,15 +303,7 @@ function(_generate_libtbx_dispatchers name path)
 
   # Process every dispatcher target we collected
   foreach(target ${dispatcher_targets})
-    get_filename_component(target_stripped_name "${target}" NAME)
-    # Get the filename without final extension
-    string(REGEX REPLACE "\\.[^.]*$" "" target_stripped_name "${target_stripped_name}")
-    # Work out if we had any "rename" directives inside the file
-    _get_libtbx_dispatcher_rename(${target} "${name}.${target_stripped_name}" dispatcher_names)
-    foreach(name ${dispatcher_names})
-      # Write this dispatcher
-      _write_dispatcher(${CMAKE_BINARY_DIR}/bin/${name} ${path}/${target})
-    endforeach()
+    _write_libtbx_script_dispatchers(${name} ${path} ${target} dispatcher_names)
   endforeach()
 endfunction()
 
@@ -263,7 +316,13 @@ function(_write_program_dispatcher destination DISPATCHER_TARGET)
   configure_file(${dispatcher_template} ${destination})
 endfunction()
 
-_write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/dials.python ${Python_EXECUTABLE})
-_write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/libtbx.python ${Python_EXECUTABLE})
-_write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/libtbx.pytest "${Python_EXECUTABLE} -mpytest")
+if (NOT CMAKE_SCRIPT_MODE_FILE)
+  _write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/dials.python ${Python_EXECUTABLE})
+  _write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/libtbx.python ${Python_EXECUTABLE})
+  _write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/libtbx.pytest "${Python_EXECUTABLE} -mpytest")
+  # Summarises the startup timings recorded with LIBTBX_DISPATCHER_PROFILE set
+  _write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/libtbx.dispatcher_profile "${Python_EXECUTABLE} ${LIBTBX_DISPATCHER_PROFILE_PY} report")
+  # Incrementally redoes the configure steps as module files change
+  _write_program_dispatcher(${CMAKE_BINARY_DIR}/bin/libtbx.watch "${Python_EXECUTABLE} ${LIBTBX_WATCH_PY}")
+endif()
 
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Generate a synthetic libtbx distribution for benchmarking.
+
+The generated tree looks like a (very) cut-down module directory:
+
+    <root>/
+        CMakeLists.txt              Configures every module with add_tbx_module
+        .generated_distribution     Marks the tree as safe to regenerate over
+        cctbx_project/
+            libtbx/                 Required by write_libtbx_env.py
+            bench_NNN/
+                CMakeLists.txt
+                libtbx_config       JSON, with extra_command_line_locations
+                libtbx_refresh.py   Writes generated files into the build
+                command_line/       Dispatcher targets
+                extra_NN/           Extra dispatcher locations
+
+Every fourth script carries a LIBTBX_SET_DISPATCHER_NAME directive, and
+each command_line folder has an __init__.py and a hidden file that must be
+skipped when generating dispatchers.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+
+try:
+    from typing import List  # noqa: F401
+except ImportError:
+    pass
+
+# The cmake/ folder holding the TBXDistribution module
+CMAKE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROOT_CMAKELISTS = """\
+cmake_minimum_required(VERSION 3.12 FATAL_ERROR)
+project(Benchmark NONE)
+
+set(Python_EXECUTABLE "{python}")
+set(CMAKE_MODULE_PATH ${{CMAKE_MODULE_PATH}} "{modules}")
+include(TBXDistribution)
+
+{subdirectories}
+"""
+
+SCRIPT = '''\
+"""Synthetic command-line script {index} for {module}"""
+{rename}
+import sys
+
+if __name__ == "__main__":
+    sys.exit(0)
+'''
+
+# Marks a tree as generated, and so safe to replace
+MARKER = ".generated_distribution"
+
+REFRESH = """\
+import os
+
+# Generate files in the same manner as e.g. the scitbx/cctbx refresh scripts
+target_dir = self.env.under_build(os.path.join("include", "{module}"))
+if not os.path.isdir(target_dir):
+    os.makedirs(target_dir)
+for i in range({count}):
+    with open(os.path.join(target_dir, "generated_%04d.h" % i), "w") as f:
+        f.write("#define {module_upper}_%04d %d\\n" % (i, i))
+"""
+
+
+def module_name(index):
+    return "bench_{:03d}".format(index)
+
+
+def _write(path, contents):
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def write_libtbx_config(path, entries, extra_locations):
+    """Write a libtbx_config of a given size, as JSON readable by sbeParseJson"""
+    config = {
+        "modules_required_for_build": ["libtbx"],
+        "modules_required_for_use": ["dep_{:03d}".format(i) for i in range(entries)],
+        "optional_modules": ["opt_{:03d}".format(i) for i in range(entries)],
+        "exclude_from_binary_bundle": [
+            "data/file_{:03d}.dat".format(i) for i in range(entries)
+        ],
+        "extra_command_line_locations": extra_locations,
+    }
+    _write(path, json.dumps(config, indent=2))
+
+
+def write_module(path, name, scripts, config_entries, extra_locations, refresh_files):
+    """Write a single synthetic libtbx module"""
+    locations = ["command_line"] + [
+        "extra_{:02d}".format(i) for i in range(extra_locations)
+    ]
+    for location in locations:
+        os.makedirs(os.path.join(path, location))
+        # Things that must not become dispatchers
+        _write(os.path.join(path, location, "__init__.py"), "")
+        _write(os.path.join(path, location, ".hidden.py"), "")
+
+    # Distribute the scripts across the locations
+    for index in range(scripts):
+        location = locations[index % len(locations)]
+        rename = ""
+        if index % 4 == 0:
+            rename = "# LIBTBX_SET_DISPATCHER_NAME {}.renamed_{}".format(name, index)
+        _write(
+            os.path.join(path, location, "script_{:03d}.py".format(index)),
+            SCRIPT.format(index=index, module=name, rename=rename),
+        )
+
+    write_libtbx_config(
+        os.path.join(path, "libtbx_config"), config_entries, locations[1:]
+    )
+    if refresh_files:
+        _write(
+            os.path.join(path, "libtbx_refresh.py"),
+            REFRESH.format(module=name, module_upper=name.upper(), count=refresh_files),
+        )
+    _write(
+        os.path.join(path, "CMakeLists.txt"),
+        "add_tbx_module({} INTERFACE)\n".format(name),
+    )
+
+
+def is_generated_distribution(root):
+    """Was a path written by generate_distribution?"""
+    return os.path.isfile(os.path.join(root, MARKER))
+
+
+def generate_distribution(
+    root,
+    modules=10,
+    scripts=10,
+    config_entries=10,
+    extra_locations=1,
+    refresh_files=10,
+    python=sys.executable,
+    force=False,
+):
+    # type: (str, int, int, int, int, int, str, bool) -> List[str]
+    """Generate a synthetic distribution, returning the list of module names.
+
+    An existing tree at <root> is removed first, but only if it is empty,
+    was previously generated, or force is set. Otherwise ValueError is raised.
+    """
+    if os.path.exists(root):
+        if not (
+            force
+            or (os.path.isdir(root) and not os.listdir(root))
+            or is_generated_distribution(root)
+        ):
+            raise ValueError(
+                "{} exists and is not a generated distribution".format(root)
+            )
+        shutil.rmtree(root)
+    cctbx_path = os.path.join(root, "cctbx_project")
+
+    # write_libtbx_env.py locates the repositories relative to libtbx
+    os.makedirs(os.path.join(cctbx_path, "libtbx"))
+    _write(os.path.join(cctbx_path, "libtbx", "__init__.py"), "")
+    _write(os.path.join(root, MARKER), "")
+
+    names = [module_name(i) for i in range(modules)]
+    for name in names:
+        write_module(
+            os.path.join(cctbx_path, name),
+            name,
+            scripts=scripts,
+            config_entries=config_entries,
+            extra_locations=extra_locations,
+            refresh_files=refresh_files,
+        )
+
+    _write(
+        os.path.join(root, "CMakeLists.txt"),
+        ROOT_CMAKELISTS.format(
+            python=python,
+            modules=os.path.join(CMAKE_ROOT, "Modules"),
+            subdirectories="\n".join(
+                "add_subdirectory(cctbx_project/{})".format(name) for name in names
+            ),
+        ),
+    )
+    return names
+
+
+def add_scale_arguments(parser):
+    """Add the arguments controlling the size of the distribution"""
+    parser.add_argument(
+        "--modules", type=int, default=10, metavar="N", help="Number of modules"
+    )
+    parser.add_argument(
+        "--scripts", type=int, default=10, metavar="N", help="Scripts per module"
+    )
+    parser.add_argument(
+        "--config-entries",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Length of each list in the libtbx_config",
+    )
+    parser.add_argument(
+        "--extra-locations",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of extra_command_line_locations per module",
+    )
+    parser.add_argument(
+        "--refresh-files",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Files written by each libtbx_refresh.py (0 for no refresh script)",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("root", help="Where to write the distribution")
+    add_scale_arguments(parser)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Replace <root> even if it doesn't look like a generated distribution",
+    )
+    args = parser.parse_args()
+
+    try:
+        names = generate_distribution(
+            args.root,
+            modules=args.modules,
+            scripts=args.scripts,
+            config_entries=args.config_entries,
+            extra_locations=args.extra_locations,
+            refresh_files=args.refresh_files,
+            force=args.force,
+        )
+    except ValueError as e:
+        sys.exit("Error: {}; use --force to replace it".format(e))
+    print("Generated {} modules in {}".format(len(names), args.root))
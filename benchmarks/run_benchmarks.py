@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Time the configure, refresh and dispatch paths on a synthetic distribution.
+
+Each stage is timed on its own, repeated, and the results written as JSON
+so that they can be compared between commits:
+
+    cmake_baseline      Configure with TBXDistribution but no modules
+    configure           Configure every module with add_tbx_module; this is
+                        dominated by _generate_libtbx_dispatchers
+    script_baseline     Start cmake in script mode, doing nothing
+    parse_config        sbeParseJson over every libtbx_config, in script mode
+    refresh             run_libtbx_refresh.py over every libtbx_refresh.py
+    write_libtbx_env    write_libtbx_env.py for every module
+    dispatch            Run a sample of the generated dispatchers
+    dispatch_profiled   As dispatch, with LIBTBX_DISPATCHER_PROFILE set
+
+The baseline stages give the fixed cost of starting cmake, to subtract
+from the stages that follow them. Only cmake, bash and python are needed.
+
+Example:
+    run_benchmarks.py --modules=50 --output=before.json
+    run_benchmarks.py --modules=50 --output=after.json --compare=before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_distribution import CMAKE_ROOT, add_scale_arguments, generate_distribution
+
+try:
+    from typing import Callable, Dict, List  # noqa: F401
+except ImportError:
+    pass
+
+LIBTBX_REFRESH_PY = os.path.join(CMAKE_ROOT, "run_libtbx_refresh.py")
+LIBTBX_ENV_PY = os.path.join(CMAKE_ROOT, "write_libtbx_env.py")
+JSON_PARSER_CMAKE = os.path.join(CMAKE_ROOT, "Modules", "JsonParser.cmake")
+
+STAGES = [
+    "cmake_baseline",
+    "configure",
+    "script_baseline",
+    "parse_config",
+    "refresh",
+    "write_libtbx_env",
+    "dispatch",
+    "dispatch_profiled",
+]
+
+PARSE_SCRIPT = """\
+include("{parser}")
+foreach(file {files})
+  file(READ ${{file}} libtbx_config_contents)
+  sbeParseJson(config libtbx_config_contents)
+  sbeClearJson(config)
+endforeach()
+"""
+
+
+def _run(command, **kwargs):
+    """Run a command quietly, raising an error showing the output on failure"""
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs
+    )
+    output = process.communicate()[0]
+    if process.returncode:
+        sys.exit(
+            "Error: Command failed: {}\n{}".format(
+                " ".join(command), output.decode("utf-8", "replace")
+            )
+        )
+
+
+def _fresh_dir(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+
+def _timed(function, setup=None):
+    # type: (Callable, Callable) -> float
+    """Time a single call of a function, excluding any setup"""
+    if setup is not None:
+        setup()
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def _summarise(times):
+    # type: (List[float]) -> Dict
+    ordered = sorted(times)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2
+    return {
+        "runs": times,
+        "min": ordered[0],
+        "max": ordered[-1],
+        "median": median,
+        "mean": sum(times) / len(times),
+    }
+
+
+class Benchmark(object):
+    """Holds the synthetic distribution and the commands for each stage"""
+
+    def __init__(self, work_dir, modules, args):
+        self.modules = modules
+        self.args = args
+        self.root = os.path.join(work_dir, "modules")
+        self.baseline_root = os.path.join(work_dir, "baseline")
+        self.build = os.path.join(work_dir, "build")
+        self.baseline_build = os.path.join(work_dir, "baseline_build")
+        self.refresh_build = os.path.join(work_dir, "refresh_build")
+        self.parse_script = os.path.join(work_dir, "parse_config.cmake")
+        self.empty_script = os.path.join(work_dir, "empty.cmake")
+        self.module_paths = [
+            os.path.join(self.root, "cctbx_project", name) for name in modules
+        ]
+
+        generate_distribution(self.baseline_root, modules=0)
+        with open(self.parse_script, "w") as f:
+            f.write(
+                PARSE_SCRIPT.format(
+                    parser=JSON_PARSER_CMAKE,
+                    files=" ".join(
+                        '"{}"'.format(os.path.join(path, "libtbx_config"))
+                        for path in self.module_paths
+                    ),
+                )
+            )
+        with open(self.empty_script, "w") as f:
+            f.write("")
+
+    def _configure(self, source, build):
+        _fresh_dir(build)
+        _run(["cmake", source], cwd=build)
+
+    def cmake_baseline(self):
+        return _timed(lambda: self._configure(self.baseline_root, self.baseline_build))
+
+    def configure(self):
+        return _timed(lambda: self._configure(self.root, self.build))
+
+    def script_baseline(self):
+        return _timed(lambda: _run(["cmake", "-P", self.empty_script]))
+
+    def parse_config(self):
+        return _timed(lambda: _run(["cmake", "-P", self.parse_script]))
+
+    def refresh(self):
+        def _refresh_all():
+            for path in self.module_paths:
+                refresh_script = os.path.join(path, "libtbx_refresh.py")
+                if not os.path.isfile(refresh_script):
+                    continue
+                _run(
+                    [
+                        sys.executable,
+                        LIBTBX_REFRESH_PY,
+                        "--root=" + self.root,
+                        "--output=" + self.refresh_build,
+                        refresh_script,
+                    ]
+                )
+
+        return _timed(_refresh_all, setup=lambda: _fresh_dir(self.refresh_build))
+
+    def write_libtbx_env(self):
+        names = ["libtbx"] + self.modules
+        paths = [os.path.join(self.root, "cctbx_project", name) for name in names]
+        return _timed(
+            lambda: _run(
+                [sys.executable, LIBTBX_ENV_PY, ";".join(names), ";".join(paths)],
+                cwd=self.build,
+            )
+        )
+
+    def _dispatchers(self):
+        bin_dir = os.path.join(self.build, "bin")
+        names = sorted(x for x in os.listdir(bin_dir) if x.startswith("bench_"))
+        return [os.path.join(bin_dir, x) for x in names[: self.args.dispatch_count]]
+
+    def _dispatch(self, env):
+        def _dispatch_all():
+            for dispatcher in self._dispatchers():
+                _run(["bash", dispatcher], env=env)
+
+        return _timed(_dispatch_all)
+
+    def dispatch(self):
+        env = dict(os.environ)
+        env.pop("LIBTBX_DISPATCHER_PROFILE", None)
+        return self._dispatch(env)
+
+    def dispatch_profiled(self):
+        env = dict(os.environ, LIBTBX_DISPATCHER_PROFILE="1")
+        return self._dispatch(env)
+
+
+def _cmake_version():
+    try:
+        output = subprocess.check_output(["cmake", "--version"])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("utf-8").splitlines()[0].split()[-1]
+
+
+def _git_commit():
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=CMAKE_ROOT, stderr=subprocess.STDOUT
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("latin1").strip()
+
+
+def compare(previous, current):
+    """Print the change in median time for every stage in both results"""
+    print("\nComparison of median times against {}".format(previous["commit"]))
+    print("Stage".ljust(20) + "     Before      After   Change")
+    for stage in STAGES:
+        if stage not in previous["stages"] or stage not in current["stages"]:
+            continue
+        before = previous["stages"][stage]["median"]
+        after = current["stages"][stage]["median"]
+        print(
+            "{} {:8.3f}s  {:8.3f}s  {:+6.1f}%".format(
+                stage.ljust(20), before, after, 100 * (after - before) / before
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    add_scale_arguments(parser)
+    parser.add_argument(
+        "--repeat", type=int, default=5, metavar="N", help="Times to run each stage"
+    )
+    parser.add_argument(
+        "--dispatch-count",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Number of dispatchers to run in the dispatch stages",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        help="Only run these stages (configure is always run if others need it)",
+    )
+    parser.add_argument(
+        "--work-dir", metavar="<dir>", help="Where to generate (default: temporary)"
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Don't remove the temporary work directory after",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="<file>",
+        default="benchmark_results.json",
+        help="Where to write the results (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compare", metavar="<file>", help="Previous results to compare against"
+    )
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="tbxcmake_bench_")
+    try:
+        modules = generate_distribution(
+            os.path.join(work_dir, "modules"),
+            modules=args.modules,
+            scripts=args.scripts,
+            config_entries=args.config_entries,
+            extra_locations=args.extra_locations,
+            refresh_files=args.refresh_files,
+        )
+        bench = Benchmark(work_dir, modules, args)
+
+        # Later stages use the output of configure, so always make sure it exists
+        if "configure" not in args.stages and any(
+            STAGES.index(x) > STAGES.index("configure") for x in args.stages
+        ):
+            bench.configure()
+
+        results = {}
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            print("Running {}...".format(stage).ljust(32), end="")
+            sys.stdout.flush()
+            times = [getattr(bench, stage)() for _ in range(args.repeat)]
+            results[stage] = _summarise(times)
+            print(
+                "median {:.3f}s  min {:.3f}s".format(
+                    results[stage]["median"], results[stage]["min"]
+                )
+            )
+    finally:
+        # Never remove a directory we were given
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        "commit": _git_commit(),
+        "timestamp": time.time(),
+        "parameters": {
+            "modules": args.modules,
+            "scripts": args.scripts,
+            "config_entries": args.config_entries,
+            "extra_locations": args.extra_locations,
+            "refresh_files": args.refresh_files,
+            "repeat": args.repeat,
+            "dispatch_count": args.dispatch_count,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "cmake": _cmake_version(),
+            "platform": platform.platform(),
+        },
+        "stages": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous["parameters"] != output["parameters"]:
+            print("Warning: Comparing runs with different parameters")
+        compare(previous, output)
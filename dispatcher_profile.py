@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Profile dispatcher startup, and report on the collected timings.
+
+The generated dispatchers call this when LIBTBX_DISPATCHER_PROFILE is set
+to a non-empty value. Each invocation appends a single JSON line to
+dispatcher_profile.jsonl in the build directory, recording:
+
+    total             Wall time from dispatcher start until the command exits
+    first_user_code   Wall time from dispatcher start until the target script
+                      begins executing
+    imports           Time spent importing modules (top-level imports only,
+                      so nested imports are not counted twice)
+    extensions        Time spent loading and initialising extension modules
+    modules           Self-time of every module imported, by name
+
+Shell-script and program dispatchers only record the total wall time.
+
+The imports are only timed for modules first imported by the target. To
+keep this true for as much of the standard library as possible, the run
+path only uses modules already loaded by interpreter startup (e.g. os,
+io, codecs, encodings, site), and runs the target the same way as the
+interpreter would, rather than through runpy (which pulls in pkgutil,
+re, typing and weakref). Those startup modules are counted as part of
+first_user_code, as they would be for an unprofiled run.
+
+Usage:
+    dispatcher_profile.py run [--log=<file>] [--name=<name>] <target> [args...]
+    dispatcher_profile.py record [--log=<file>] [--name=<name>] --end=<time>
+    dispatcher_profile.py report [--log=<file>] [--imports=<N>] [dispatcher...]
+"""
+
+import os
+import sys
+import time
+
+# Both loaded by interpreter startup, unlike threading/importlib.machinery
+from _frozen_importlib_external import ExtensionFileLoader
+from _thread import _local as thread_local
+
+# Fallback for when the dispatcher could not tell us when it started
+_profile_start = time.time()
+
+# Importing typing would pull in re, so it's only imported for type checking
+MYPY = False
+if MYPY:
+    from typing import Dict, List, Optional  # noqa: F401
+
+DEFAULT_LOG_NAME = "dispatcher_profile.jsonl"
+
+
+def _parse_timestamp(value):
+    # type: (Optional[str]) -> Optional[float]
+    """Read a shell timestamp, which may be missing or locale-formatted."""
+    if not value:
+        return None
+    try:
+        return float(value.replace(",", "."))
+    except ValueError:
+        # e.g. date on macOS does not understand %N
+        return None
+
+
+def _default_log():
+    return os.path.join(os.environ.get("LIBTBX_BUILD", os.getcwd()), DEFAULT_LOG_NAME)
+
+
+def _append_record(log, record):
+    """Write a single profile record as one line of the log."""
+    import json
+
+    line = json.dumps(record, sort_keys=True, separators=(",", ":")) + "\n"
+    try:
+        with open(log, "a") as f:
+            f.write(line)
+    except (IOError, OSError) as e:
+        # Never let profiling break the command being profiled
+        print(
+            "Warning: Could not write dispatcher profile: {}".format(e),
+            file=sys.stderr,
+        )
+
+
+class ImportTimer(object):
+    """Meta-path finder that times the loading of every module imported.
+
+    Rather than wrapping the loader (which breaks isinstance checks e.g. by
+    pkg_resources), the create_module/exec_module methods of each loader
+    instance are replaced with timed versions.
+    """
+
+    def __init__(self):
+        self.modules = {}  # type: Dict[str, float]
+        self.extension_modules = set()
+        self.imports = 0.0
+        self.extensions = 0.0
+        self._local = thread_local()
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        # Class-level loaders e.g. BuiltinImporter are shared, so leave alone
+        if spec.loader is not None and not isinstance(spec.loader, type):
+            self._wrap_loader(spec.loader)
+        return spec
+
+    def _wrap_loader(self, loader):
+        is_extension = isinstance(loader, ExtensionFileLoader)
+        for method, get_name in (
+            ("create_module", lambda spec: spec.name),
+            ("exec_module", lambda module: module.__spec__.name),
+        ):
+            original = getattr(loader, method, None)
+            # Some loaders (e.g. zipimporter) are shared between modules
+            if original is None or getattr(original, "_profiled", False):
+                continue
+            try:
+                setattr(loader, method, self._timed(original, get_name, is_extension))
+            except (AttributeError, TypeError):
+                # e.g. loaders with __slots__; these just go untimed
+                continue
+
+    def _timed(self, original, get_name, is_extension):
+        def _wrapper(arg):
+            stack = self._local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            start = time.time()
+            try:
+                return original(arg)
+            finally:
+                elapsed = time.time() - start
+                own = elapsed - stack.pop()
+                name = get_name(arg)
+                self.modules[name] = self.modules.get(name, 0.0) + own
+                if is_extension:
+                    self.extension_modules.add(name)
+                    self.extensions += own
+                if stack:
+                    stack[-1] += elapsed
+                else:
+                    self.imports += elapsed
+
+        _wrapper._profiled = True  # type: ignore
+        return _wrapper
+
+
+def run(log, name, target, args):
+    """Run a python script as __main__, recording startup timings"""
+    start = _parse_timestamp(os.environ.get("LIBTBX_DISPATCHER_START"))
+    if start is None:
+        start = _profile_start
+
+    timer = ImportTimer()
+    timer.install()
+
+    # Make it look like the target was run directly
+    sys.argv = [target] + list(args)
+    sys.path[0] = os.path.dirname(os.path.abspath(target))
+    main = type(sys)("__main__")
+    main.__file__ = target
+    main.__builtins__ = __builtins__
+    sys.modules["__main__"] = main
+
+    exit_code = 1
+    first_user_code = time.time() - start
+    try:
+        with open(target, "rb") as f:
+            code = compile(f.read(), target, "exec")
+        exec(code, vars(main))
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        raise
+    finally:
+        end = time.time()
+        timer.uninstall()
+        _append_record(
+            log,
+            {
+                "dispatcher": name,
+                "target": target,
+                "start": start,
+                "exit_code": exit_code,
+                "total": end - start,
+                "first_user_code": first_user_code,
+                "imports": timer.imports,
+                "extensions": timer.extensions,
+                "modules": timer.modules,
+                "extension_modules": sorted(timer.extension_modules),
+            },
+        )
+
+
+def record(log, name, end, exit_code):
+    """Record a dispatcher run that was timed by the dispatcher itself"""
+    start = _parse_timestamp(os.environ.get("LIBTBX_DISPATCHER_START"))
+    end = _parse_timestamp(end)
+    if start is None or end is None:
+        print(
+            "Warning: No usable dispatcher timestamps; not recording profile",
+            file=sys.stderr,
+        )
+        return
+    _append_record(
+        log,
+        {
+            "dispatcher": name,
+            "start": start,
+            "exit_code": exit_code,
+            "total": end - start,
+        },
+    )
+
+
+def read_log(log):
+    """Read every record in a profile log, skipping any corrupt lines"""
+    import json
+
+    records = []
+    with open(log) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # e.g. a partially-written line from an interrupted command
+                continue
+    return records
+
+
+def percentile(values, pct):
+    # type: (List[float], float) -> float
+    """Linearly interpolated percentile of a list of values"""
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    position = (len(values) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+# Columns shown in the report, and the record key for each
+_REPORT_COLUMNS = [
+    ("total", "Total"),
+    ("first_user_code", "First code"),
+    ("imports", "Imports"),
+    ("extensions", "Extensions"),
+]
+
+
+def report(records, dispatchers=None, show_imports=0):
+    """Print p50/p95 timings (in ms) per dispatcher"""
+    by_name = {}  # type: Dict[str, List[dict]]
+    for entry in records:
+        if dispatchers and entry["dispatcher"] not in dispatchers:
+            continue
+        by_name.setdefault(entry["dispatcher"], []).append(entry)
+
+    if not by_name:
+        print("No dispatcher profiles recorded")
+        return
+
+    namelen = max([len(x) for x in by_name] + [10])
+    header = "Dispatcher".ljust(namelen) + "  Runs"
+    for _, title in _REPORT_COLUMNS:
+        header += "  " + (title + " p50/p95").rjust(21)
+    print(header)
+    for name, entries in sorted(by_name.items()):
+        line = name.ljust(namelen) + "  " + str(len(entries)).rjust(4)
+        for key, _ in _REPORT_COLUMNS:
+            values = [x[key] * 1000 for x in entries if key in x]
+            if values:
+                cell = "{:.1f} / {:.1f}".format(
+                    percentile(values, 50), percentile(values, 95)
+                )
+            else:
+                cell = "-"
+            line += "  " + cell.rjust(21)
+        print(line)
+
+    if show_imports:
+        # Collect the self-time for every module across all runs
+        module_times = {}  # type: Dict[str, List[float]]
+        for entries in by_name.values():
+            for entry in entries:
+                for module, value in entry.get("modules", {}).items():
+                    module_times.setdefault(module, []).append(value * 1000)
+        slowest = sorted(
+            module_times.items(), key=lambda x: percentile(x[1], 50), reverse=True
+        )[:show_imports]
+        if not slowest:
+            return
+        print()
+        modlen = max([len(x) for x, _ in slowest] + [6])
+        print("Module".ljust(modlen) + "  Runs  Self p50/p95 (ms)")
+        for module, values in slowest:
+            print(
+                "{}  {}  {:.2f} / {:.2f}".format(
+                    module.ljust(modlen),
+                    str(len(values)).rjust(4),
+                    percentile(values, 50),
+                    percentile(values, 95),
+                )
+            )
+
+
+def _parse_run_arguments(argv):
+    """Parse the run arguments by hand, so that argparse isn't preloaded"""
+    log, name = _default_log(), None
+    while argv and argv[0].startswith("--"):
+        option = argv.pop(0)
+        key, has_value, value = option.partition("=")
+        if not has_value and argv:
+            value = argv.pop(0)
+        if key == "--log":
+            log = value
+        elif key == "--name":
+            name = value
+        else:
+            sys.exit("Error: Unknown run option {}".format(option))
+    if not argv:
+        sys.exit("Error: No target script to run")
+    return log, name or argv[0], argv[0], argv[1:]
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["run"]:
+    log, name, target, args = _parse_run_arguments(sys.argv[2:])
+    run(log, os.path.basename(name), target, args)
+elif __name__ == "__main__":
+    import argparse
+
+    # The run parser is only here for the --help text
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Run and profile a python script")
+    run_parser.add_argument("--log", metavar="<file>", default=_default_log())
+    run_parser.add_argument("--name", metavar="<name>", help="The dispatcher name")
+    run_parser.add_argument("target", help="The script to run")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER)
+
+    record_parser = subparsers.add_parser(
+        "record", help="Record an externally-timed dispatcher run"
+    )
+    record_parser.add_argument("--log", metavar="<file>", default=_default_log())
+    record_parser.add_argument("--name", metavar="<name>", required=True)
+    record_parser.add_argument("--end", metavar="<time>", required=True)
+    record_parser.add_argument("--exit-code", type=int, default=0)
+
+    report_parser = subparsers.add_parser("report", help="Summarise a profile log")
+    report_parser.add_argument("--log", metavar="<file>", default=_default_log())
+    report_parser.add_argument(
+        "--imports",
+        metavar="<N>",
+        type=int,
+        default=0,
+        help="Also show the N slowest modules to import",
+    )
+    report_parser.add_argument(
+        "dispatchers", nargs="*", help="Only report on these dispatchers"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.log, os.path.basename(args.name), args.end, args.exit_code)
+    else:
+        if not os.path.isfile(args.log):
+            sys.exit("Error: No dispatcher profile log at {}".format(args.log))
+        report(read_log(args.log), args.dispatchers, args.imports)
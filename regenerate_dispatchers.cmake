@@ -0,0 +1,48 @@
+# Regenerate the dispatchers for a single libtbx module, outside of a
+# full configure. Run from the build directory as:
+#
+#   cmake -DTBX_SOURCE_DIR=<dir> -DPython_EXECUTABLE=<python>
+#         -DTBX_MODULE=<name> -DTBX_MODULE_PATH=<path>
+#         [-DTBX_TARGETS=<target>[;<target>...]]
+#         -P regenerate_dispatchers.cmake
+#
+# If TBX_TARGETS is given then only the dispatchers for these scripts
+# (relative to the module path) are written, otherwise every dispatcher for
+# the module is. The locations searched and the dispatchers written are
+# reported on stdout, for watch_libtbx.py to read, as:
+#
+#   -- Location <location>
+#   -- Dispatcher <target> <name>
+
+cmake_minimum_required(VERSION 3.12)
+
+foreach(var TBX_SOURCE_DIR Python_EXECUTABLE TBX_MODULE TBX_MODULE_PATH)
+  if (NOT DEFINED ${var})
+    message(FATAL_ERROR "regenerate_dispatchers.cmake requires -D${var}")
+  endif()
+endforeach()
+
+# Make the dispatchers look the same as those written by the configure
+set(CMAKE_SOURCE_DIR ${TBX_SOURCE_DIR})
+
+include(${CMAKE_CURRENT_LIST_DIR}/Modules/TBXDistribution.cmake)
+
+_find_libtbx_dispatcher_targets(${TBX_MODULE_PATH} locations targets)
+foreach(location ${locations})
+  message(STATUS "Location ${location}")
+endforeach()
+
+if (DEFINED TBX_TARGETS)
+  set(targets ${TBX_TARGETS})
+endif()
+
+foreach(target ${targets})
+  # Deleted scripts have no dispatchers
+  if (NOT EXISTS ${TBX_MODULE_PATH}/${target})
+    continue()
+  endif()
+  _write_libtbx_script_dispatchers(${TBX_MODULE} ${TBX_MODULE_PATH} ${target} dispatcher_names)
+  foreach(dispatcher_name ${dispatcher_names})
+    message(STATUS "Dispatcher ${target} ${dispatcher_name}")
+  endforeach()
+endforeach()
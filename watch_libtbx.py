@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Watch the libtbx modules, and incrementally redo the configure steps.
+
+Normally adding a command_line script, changing a LIBTBX_SET_DISPATCHER_NAME
+or editing a libtbx_config needs a full CMake reconfigure. This watches the
+modules registered with add_tbx_module (using Linux inotify) and redoes only
+the steps affected by each change:
+
+    command-line script     Regenerate that script's dispatchers
+    libtbx_config           Regenerate all dispatchers for that module
+    libtbx_refresh.py       Rerun that refresh script, if it was registered
+                            with add_libtbx_refresh_command
+    libtbx_env removed      Rewrite the libtbx_env
+
+Changes to the templates and scripts used to generate these are also
+followed. Dispatchers for deleted or renamed scripts are removed.
+
+Adding or removing whole modules still needs a CMake reconfigure.
+
+Run from the build directory, after configuring at least once.
+"""
+
+from __future__ import print_function
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import subprocess
+import sys
+import time
+
+try:
+    from typing import Dict, List, Optional, Set, Tuple  # noqa: F401
+except ImportError:
+    pass
+
+CMAKE_ROOT = os.path.dirname(os.path.abspath(__file__))
+REGENERATE_CMAKE = os.path.join(CMAKE_ROOT, "regenerate_dispatchers.cmake")
+LIBTBX_REFRESH_PY = os.path.join(CMAKE_ROOT, "run_libtbx_refresh.py")
+LIBTBX_ENV_PY = os.path.join(CMAKE_ROOT, "write_libtbx_env.py")
+
+# Files that change how each step is done, relative to CMAKE_ROOT
+DISPATCHER_TOOLS = {
+    "dispatcher.py.template",
+    "dispatcher.sh.template",
+    "regenerate_dispatchers.cmake",
+    os.path.join("Modules", "TBXDistribution.cmake"),
+    os.path.join("Modules", "JsonParser.cmake"),
+}
+REFRESH_TOOLS = {"run_libtbx_refresh.py"}
+ENV_TOOLS = {"write_libtbx_env.py"}
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+IN_REMOVED = IN_DELETE | IN_MOVED_FROM
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+_EVENT_STRUCT = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify API"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+
+    def _raise_errno(self, path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails if the kernel already removed it e.g. on deletion; that's fine
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Read the currently queued events as (wd, mask, name) tuples"""
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_STRUCT.unpack_from(data, offset)
+            offset += _EVENT_STRUCT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_dispatcher_target(filename):
+    """Would _find_libtbx_dispatcher_targets make a dispatcher for this?"""
+    return (
+        filename.endswith((".py", ".sh"))
+        and filename != "__init__.py"
+        and not filename.startswith(".")
+    )
+
+
+class Watcher(object):
+    """Maps changes in the watched directories to the configure steps to redo.
+
+    Steps are tuples of:
+        ("env",)
+        ("module", <module>)            All dispatchers for a module
+        ("script", <module>, <target>)  Dispatchers for a single script
+        ("refresh", <module>)
+    """
+
+    def __init__(self, build_dir, settings, modules):
+        # type: (str, Dict, Dict[str, str]) -> None
+        self.build_dir = build_dir
+        self.bin_dir = os.path.join(build_dir, "bin")
+        self.source_dir = settings["source_dir"]
+        self.python = settings["python"]
+        self.cmake = settings["cmake"]
+        self.refresh_scripts = set(settings.get("refresh_scripts", []))
+        self.modules = modules
+        self.inotify = Inotify()
+        # wd -> (module, directory relative to the module). Module is None
+        # for the CMAKE_ROOT tool directories and the build directory.
+        self.watches = {}  # type: Dict[int, Tuple[Optional[str], str]]
+        # module -> locations searched for dispatcher targets
+        self.locations = {}  # type: Dict[str, List[str]]
+        # module -> target -> dispatcher names
+        self.dispatchers = {}  # type: Dict[str, Dict[str, List[str]]]
+
+    def _watch(self, path, module, relative):
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            print("Warning: Could not watch {}: {}".format(path, e.strerror))
+            return
+        self.watches[wd] = (module, relative)
+
+    def _unwatch(self, module, relative):
+        for wd, watch in list(self.watches.items()):
+            if watch == (module, relative):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _update_location_watches(self, module, locations):
+        watched = {x for m, x in self.watches.values() if m == module and x}
+        for location in watched - set(locations):
+            self._unwatch(module, location)
+        # Locations that don't exist yet are watched once they are created
+        for location in set(locations) - watched:
+            path = os.path.join(self.modules[module], location)
+            if os.path.isdir(path):
+                self._watch(path, module, location)
+        self.locations[module] = locations
+
+    def start(self):
+        """Watch everything, and bring all dispatchers up to date"""
+        self._watch(CMAKE_ROOT, None, "")
+        self._watch(os.path.join(CMAKE_ROOT, "Modules"), None, "Modules")
+        self._watch(self.build_dir, None, self.build_dir)
+        for module, path in sorted(self.modules.items()):
+            self._watch(path, module, "")
+            self.regenerate_dispatchers(module)
+
+    def steps_for_event(self, wd, mask, name):
+        # type: (int, int, str) -> Set[Tuple[str, ...]]
+        """Work out the smallest set of steps needed for an inotify event"""
+        if mask & IN_Q_OVERFLOW:
+            print("Warning: Missed events; redoing everything")
+            return self.all_steps()
+        if wd not in self.watches:
+            return set()
+        module, relative = self.watches[wd]
+        if mask & IN_IGNORED:
+            # The kernel removed this watch, normally because it was deleted
+            del self.watches[wd]
+            return set()
+
+        if module is None:
+            if relative == self.build_dir:
+                if name in {"libtbx_env", "libtbx_env.json"} and mask & IN_REMOVED:
+                    return {("env",)}
+                return set()
+            tool = os.path.join(relative, name)
+            if tool in DISPATCHER_TOOLS:
+                return {("module", x) for x in self.modules}
+            elif tool in REFRESH_TOOLS:
+                return {("refresh", x) for x in self.modules}
+            elif tool in ENV_TOOLS:
+                return {("env",)}
+            return set()
+
+        # The watched directory itself went away
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if not relative:
+                print("Warning: Module {} was removed".format(module))
+            return {("module", module)}
+
+        if not relative:
+            # Module root
+            if name == "libtbx_config":
+                return {("module", module)}
+            elif name == "libtbx_refresh.py":
+                return {("refresh", module)}
+            elif mask & IN_ISDIR and any(
+                x.split("/")[0] == name for x in self.locations.get(module, [])
+            ):
+                # A dispatcher location was created or removed
+                return {("module", module)}
+        elif not mask & IN_ISDIR and is_dispatcher_target(name):
+            return {("script", module, relative + "/" + name)}
+        return set()
+
+    def all_steps(self):
+        steps = {("env",)}  # type: Set[Tuple[str, ...]]
+        for module in self.modules:
+            steps.add(("module", module))
+            steps.add(("refresh", module))
+        return steps
+
+    def run_steps(self, steps):
+        # type: (Set[Tuple[str, ...]]) -> None
+        """Do the steps, in the same order that the configure would"""
+        if ("env",) in steps:
+            self.write_env()
+        full_modules = {step[1] for step in steps if step[0] == "module"}
+        for module in sorted(full_modules):
+            self.regenerate_dispatchers(module)
+        # Group the individual scripts to do each module in one go
+        targets = {}  # type: Dict[str, List[str]]
+        for step in steps:
+            if step[0] == "script" and step[1] not in full_modules:
+                targets.setdefault(step[1], []).append(step[2])
+        for module, module_targets in sorted(targets.items()):
+            self.regenerate_dispatchers(module, sorted(module_targets))
+        for module in sorted(step[1] for step in steps if step[0] == "refresh"):
+            self.run_refresh(module)
+
+    def _run(self, command, description):
+        """Run a step command, returning the output or None on failure"""
+        start = time.time()
+        try:
+            process = subprocess.Popen(
+                command,
+                cwd=self.build_dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        except OSError as e:
+            print("Error: Failed to {}: {}".format(description, e))
+            return None
+        output = process.communicate()[0].decode("utf-8", "replace")
+        if process.returncode:
+            print("Error: Failed to {}:\n{}".format(description, output))
+            return None
+        print("{} ({:.2f}s)".format(description, time.time() - start))
+        return output
+
+    def regenerate_dispatchers(self, module, targets=None):
+        # type: (str, Optional[List[str]]) -> None
+        """Regenerate all dispatchers for a module, or only those for targets"""
+        command = [
+            self.cmake,
+            "-DTBX_SOURCE_DIR=" + self.source_dir,
+            "-DPython_EXECUTABLE=" + self.python,
+            "-DTBX_MODULE=" + module,
+            "-DTBX_MODULE_PATH=" + self.modules[module],
+        ]
+        if targets is None:
+            description = "Regenerate {} dispatchers".format(module)
+        else:
+            command.append("-DTBX_TARGETS=" + ";".join(targets))
+            description = "Regenerate dispatchers for {}".format(
+                ", ".join("{}/{}".format(module, x) for x in targets)
+            )
+        command.extend(["-P", REGENERATE_CMAKE])
+        output = self._run(command, description)
+        if output is None:
+            return
+
+        locations = []
+        written = {}  # type: Dict[str, List[str]]
+        for line in output.splitlines():
+            parts = line.split()
+            if parts[:2] == ["--", "Location"]:
+                locations.append(parts[2])
+            elif parts[:2] == ["--", "Dispatcher"]:
+                written.setdefault(parts[2], []).append(parts[3])
+        self._update_location_watches(module, locations)
+
+        # Work out which dispatchers are no longer generated by anything
+        current = self.dispatchers.setdefault(module, {})
+        if targets is None:
+            targets = list(set(current) | set(written))
+        stale = set()
+        for target in targets:
+            stale.update(current.pop(target, []))
+            if target in written:
+                current[target] = written[target]
+        for dispatchers in self.dispatchers.values():
+            for names in dispatchers.values():
+                stale.difference_update(names)
+        for name in sorted(stale):
+            path = os.path.join(self.bin_dir, name)
+            if os.path.isfile(path):
+                print("Removing dispatcher {}".format(name))
+                os.remove(path)
+
+    def run_refresh(self, module):
+        refresh_script = os.path.join(self.modules[module], "libtbx_refresh.py")
+        if refresh_script not in self.refresh_scripts:
+            return
+        self._run(
+            [
+                self.python,
+                LIBTBX_REFRESH_PY,
+                "--root=" + self.source_dir,
+                "--output=" + self.build_dir,
+                refresh_script,
+            ],
+            "Refresh {}".format(module),
+        )
+
+    def write_env(self):
+        names = sorted(self.modules)
+        self._run(
+            [
+                self.python,
+                LIBTBX_ENV_PY,
+                ";".join(names),
+                ";".join(self.modules[x] for x in names),
+            ],
+            "Write libtbx_env",
+        )
+
+    def run(self, delay):
+        """Wait for changes, redoing steps once they have been quiet for <delay>"""
+        pending = set()  # type: Set[Tuple[str, ...]]
+        while True:
+            ready, _, _ = select.select(
+                [self.inotify.fd], [], [], delay if pending else None
+            )
+            if ready:
+                for wd, mask, name in self.inotify.read_events():
+                    pending |= self.steps_for_event(wd, mask, name)
+            elif pending:
+                self.run_steps(pending)
+                pending = set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--build",
+        metavar="<dir>",
+        default=os.environ.get("LIBTBX_BUILD", os.getcwd()),
+        help="The build directory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--delay",
+        metavar="<seconds>",
+        type=float,
+        default=0.2,
+        help="How long to wait for changes to finish before acting",
+    )
+    args = parser.parse_args()
+
+    if not sys.platform.startswith("linux"):
+        sys.exit("Error: Watching requires Linux inotify")
+
+    build_dir = os.path.abspath(args.build)
+    try:
+        with open(os.path.join(build_dir, "libtbx_watch.json")) as f:
+            settings = json.load(f)
+        with open(os.path.join(build_dir, "libtbx_env.json")) as f:
+            modules = json.load(f)
+    except IOError as e:
+        sys.exit("Error: {}; has {} been configured?".format(e.strerror, build_dir))
+
+    watcher = Watcher(build_dir, settings, modules)
+    watcher.start()
+    print("Watching {} modules for changes".format(len(modules)))
+    try:
+        watcher.run(args.delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.inotify.close()